@@ -19,7 +19,7 @@ typedef enum{
     ADAM_MODE_1   =1  // eps outside square root
 } adamMode_t;
 
-template <int DEPTH, typename PARAM_T, typename GRAD_T, typename OPTIM_T>
+template <int DEPTH, typename PARAM_T, typename GRAD_T, typename OPTIM_T, bool COMPENSATED = false>
 struct AdamFunctor
 {
     __device__ __forceinline__ void operator()(
@@ -50,7 +50,14 @@ struct AdamFunctor
         GRAD_T* g = (GRAD_T *)tl.addresses[3][tensor_loc];
         g += chunk_idx*chunk_size;
         at::Half* p_copy = NULL;
-        if (DEPTH == 5) {
+        at::Half* c = NULL;
+        if (DEPTH == 5 && COMPENSATED) {
+            // Pure FP16 with Kahan summation: the fifth list holds the
+            // compensation buffer carrying the low-order bits lost when
+            // writing the updated parameter back in half precision
+            c = (at::Half*)tl.addresses[4][tensor_loc];
+            c += chunk_idx*chunk_size;
+        } else if (DEPTH == 5) {
             p_copy = (at::Half*)tl.addresses[4][tensor_loc];
             p_copy += chunk_idx*chunk_size;
         }
@@ -111,8 +118,15 @@ struct AdamFunctor
                         else // Mode 1
                             denom = sqrtf(velocity) + eps;
                         float update = (momentum/denom) + (decay*incoming_p[ii]);
-                        p[j] = (PARAM_T)(incoming_p[ii] - (step_size*update));
-                        if (DEPTH == 5)  p_copy[j] = (at::Half) p[j];
+                        if (COMPENSATED) {
+                            float delta = static_cast<float>(c[j]) - (step_size*update);
+                            PARAM_T new_p = (PARAM_T)(static_cast<float>(incoming_p[ii]) + delta);
+                            c[j] = (at::Half)(delta - (static_cast<float>(new_p) - static_cast<float>(incoming_p[ii])));
+                            p[j] = new_p;
+                        } else {
+                            p[j] = (PARAM_T)(incoming_p[ii] - (step_size*update));
+                            if (DEPTH == 5)  p_copy[j] = (at::Half) p[j];
+                        }
                     } else {
                         // Optimizer state is in floating point precision
                         float scaled_grad = incoming_g[ii]/grad_scale;
@@ -138,7 +152,7 @@ struct AdamFunctor
 void fused_adam_cuda(
     int chunk_size,
     at::Tensor noop_flag,
-    std::vector<std::vector<at::Tensor>> tensor_lists, // p, m, v, g, p_copy
+    std::vector<std::vector<at::Tensor>> tensor_lists, // p, m, v, g, p_copy or compensation
     float lr,
     float beta1,
     float beta2,
@@ -170,7 +184,29 @@ void fused_adam_cuda(
     bool use_optim_scaling = (tensor_lists[1][0].scalar_type() == at::ScalarType::Half);
     float* found_inf_ptr = found_inf.data_ptr<float>();
 
-    if(tl_sz == 5) {
+    if(tl_sz == 5 && tensor_lists[0][0].scalar_type() == at::ScalarType::Half) {
+        // Pure FP16 case with Kahan-compensated parameter updates
+        assert(tensor_lists[1][0].scalar_type() == at::ScalarType::Half);
+        assert(tensor_lists[3][0].scalar_type() == at::ScalarType::Half);
+        assert(tensor_lists[4][0].scalar_type() == at::ScalarType::Half);
+        multi_tensor_apply<5>(
+            BLOCK_SIZE,
+            chunk_size,
+            noop_flag,
+            tensor_lists,
+            AdamFunctor<5, at::Half, at::Half, at::Half, true>(),
+            beta1,
+            beta2,
+            eps,
+            grad_scale,
+            use_optim_scaling,
+            optim_scale,
+            found_inf_ptr,
+            step_size,
+            (adamMode_t) mode,
+            decay
+        );
+    } else if(tl_sz == 5) {
         // Mixed precision case
         assert(tensor_lists[0][0].scalar_type() == at::ScalarType::Float);
         assert(tensor_lists[3][0].scalar_type() == at::ScalarType::Half);
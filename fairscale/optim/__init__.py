@@ -11,6 +11,6 @@ try:
     from .adam import Adam, Precision
 except ImportError:  # pragma: no cover
     pass  # pragma: no cover
-from .adascale import AdaScale
+from .adascale import AdaScale, AdaScaleLambdaLR
 from .grad_scaler import GradScaler
 from .oss import OSS
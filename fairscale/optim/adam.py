@@ -4,6 +4,7 @@
 # LICENSE file in the root directory of this source tree.
 
 from enum import Enum, auto
+import math
 from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
 
 import torch
@@ -13,6 +14,71 @@ if TYPE_CHECKING:
 else:
     _params_t = Any
 
+
+def reference_adam_step(
+    param: torch.Tensor,
+    grad: torch.Tensor,
+    exp_avg: torch.Tensor,
+    exp_avg_sq: torch.Tensor,
+    step: int,
+    lr: float,
+    betas: Tuple[float, float] = (0.9, 0.999),
+    eps: float = 1e-8,
+    weight_decay: float = 0.0,
+    bias_correction: bool = True,
+    eps_inside_sqrt: bool = False,
+    grad_scale: float = 1.0,
+    optim_scale: float = 1.0,
+    compensation: Optional[torch.Tensor] = None,
+) -> bool:
+    """
+    Device-agnostic reference of the update performed by ``fused_adam_cuda``, applied
+    in place to a single parameter tensor. The math is done in FP32 and the results are
+    written back in the storage precision of each tensor, exactly as the kernel does,
+    so that the CUDA paths can be validated against it on CPU.
+
+    Optimizer states stored in FP16 are kept multiplied by ``optim_scale``. If
+    ``compensation`` is given, the parameter update uses Kahan summation: the rounding
+    error of the write-back is stored in ``compensation`` and added to the next update,
+    so that updates smaller than the precision of ``param`` are not lost.
+
+    Returns True if the optimizer state overflowed.
+    """
+    beta1, beta2 = betas
+    use_optim_scaling = exp_avg.dtype == torch.float16
+    state_scale = optim_scale if use_optim_scaling else 1.0
+
+    if bias_correction:
+        step_size = lr * math.sqrt(1 - beta2 ** step) / (1 - beta1 ** step)
+    else:
+        step_size = lr
+
+    p = param.data.float()
+    scaled_grad = grad.data.float() / grad_scale
+    momentum = beta1 * (exp_avg.float() / state_scale) + (1 - beta1) * scaled_grad
+    velocity = beta2 * (exp_avg_sq.float() / state_scale) + (1 - beta2) * scaled_grad * scaled_grad
+
+    exp_avg.copy_(momentum * state_scale)
+    exp_avg_sq.copy_(velocity * state_scale)
+    found_inf = use_optim_scaling and not bool(torch.isfinite(exp_avg).all() and torch.isfinite(exp_avg_sq).all())
+
+    if eps_inside_sqrt:
+        denom = (velocity + eps).sqrt()
+    else:
+        denom = velocity.sqrt() + eps
+    update = momentum / denom + weight_decay * p
+
+    if compensation is None:
+        param.data.copy_(p - step_size * update)
+    else:
+        delta = compensation.float() - step_size * update
+        new_p = (p + delta).to(param.dtype)
+        compensation.copy_(delta - (new_p.float() - p))
+        param.data.copy_(new_p)
+
+    return found_inf
+
+
 try:
     from fairscale import fused_adam_cuda  # type: ignore
 
@@ -67,6 +133,10 @@ try:
                 Precision.MIXED_PRECISION, Precision.MEMORY_EFFICIENT_MIXED_PRECISION
                 or Precision.PURE_FP16. Inferred based on model parameter precision if
                 None. (default: None)
+            kahan_summation (boolean, optional): only valid with Precision.PURE_FP16.
+                Keeps an FP16 compensation buffer per parameter holding the rounding
+                error of each update, so that updates too small to be represented in
+                FP16 accumulate instead of being rounded away. (default: False)
         .. _Adam: A Method for Stochastic Optimization:
             https://arxiv.org/abs/1412.6980
         .. _On the Convergence of Adam and Beyond:
@@ -85,6 +155,7 @@ try:
             max_grad_norm: Optional[float] = 0.0,
             amsgrad: Optional[bool] = False,
             precision: Optional[Precision] = None,
+            kahan_summation: Optional[bool] = False,
         ):
             parameters: List[Any] = list(params)
             self.precision = precision
@@ -97,6 +168,10 @@ try:
             if self.precision is not Precision.FULL_PRECISION:
                 assert parameters[0].dtype == torch.float16
 
+            if kahan_summation:
+                assert self.precision is Precision.PURE_FP16
+            self.kahan_summation = kahan_summation
+
             self.optim_type = torch.float16 if precision is Precision.PURE_FP16 else torch.float32
             self._optim_scale = float(2 ** 16) if precision is Precision.PURE_FP16 else 1.0
             self._steps_since_optim_scale_change = 0
@@ -227,6 +302,11 @@ try:
                         # Exponential moving average of squared gradient values
                         state["exp_avg_sq"] = torch.zeros_like(p, dtype=self.optim_type)
 
+                    if self.kahan_summation and "compensation" not in state:
+                        # Rounding error of the FP16 parameter updates, also created
+                        # lazily when resuming from a state saved without it
+                        state["compensation"] = torch.zeros_like(p)
+
                     exp_avg = state["exp_avg"]
                     exp_avg_sq = state["exp_avg_sq"]
                     beta1, beta2 = group["betas"]
@@ -246,9 +326,11 @@ try:
                             tl.append(t)
                     else:
                         pl = [param.data, exp_avg, exp_avg_sq, grad]
+                        if self.kahan_summation:
+                            pl.append(state["compensation"])
 
                         if p.device not in tensorlists:
-                            tensorlists[p.device] = [[], [], [], []]
+                            tensorlists[p.device] = [[] for _ in pl]
 
                         for tl, t in zip(tensorlists[p.device], pl):
                             tl.append(t)
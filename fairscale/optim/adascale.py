@@ -31,13 +31,17 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import copy
 import functools
 import logging
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, List, Optional, Union, cast
 
 import numpy as np
 from torch.autograd import Variable
 import torch.distributed
+from torch.optim.lr_scheduler import _LRScheduler
+
+from .oss import OSS
 
 
 class AdaScale(object):
@@ -59,15 +63,55 @@ class AdaScale(object):
                 loss.backward()
                 adascale.step()
 
+    AdaScale can also emulate a larger scale on fewer workers by accumulating
+    gradients over several backward passes before each step. The gradient
+    variance is then estimated from the local micro-batch gradients as well.
+
+    .. code-block:: python
+
+        optim = torch.optim.SGD(model, lr=0.001)
+        adascale = AdaScale(optim, num_gradients_to_accumulate=4)
+
+        for epoch in ...:
+            for i, batch in enumerate(...):
+                loss = ...
+                loss.backward()
+                if (i + 1) % 4 == 0:
+                    adascale.step()
+                    optim.zero_grad()
+
+    AdaScale also works with :class:`fairscale.nn.ShardedDataParallel`, by
+    passing it the sharded optimizer. Since the gradients are only reduced
+    when calling ``reduce()``, the statistics are then updated at the
+    beginning of :meth:`step`.
+
+    .. code-block:: python
+
+        model = ShardedDataParallel(model, torch.optim.SGD, {"lr": 0.001}, world_size, False)
+        adascale = AdaScale(model.optimizer)
+
+        for epoch in ...:
+            for batch in ...:
+                adascale.zero_grad()
+                loss = ...
+                loss.backward()
+                model.reduce()
+                adascale.step()
+
     Arguments:
         optimizer (torch.optim.Optimizer): Optimizer to apply AdaScale to.
         world_size (int): Number of world_size for distributed training. If
-            None, defaults to ``torch.distributed.get_world_size()``.
+            None, defaults to the world size of the :class:`OSS` optimizer
+            group, or to ``torch.distributed.get_world_size()``, or 1 if
+            ``torch.distributed`` is not initialized.
         scale (float): Scaling factor of the batch size, e.g. using a 10x
             larger batch size (summed across all world_size) means a scale of
-            10. If None, defaults to ``world_size``.
+            10. If None, defaults to ``world_size * num_gradients_to_accumulate``.
         patch_optimizer (bool): If True, monkey-patches the ``step`` method of
             the optimizer with the AdaScale ``step`` method.
+        num_gradients_to_accumulate (int): Number of backward passes whose
+            gradients are summed into ``param.grad`` before each step. Each of
+            them counts as one worker when estimating the gradient variance.
 
     .. _AdaScale: https://proceedings.icml.cc/static/paper_files/icml/2020/4682-Supplemental.pdf
     """
@@ -79,26 +123,41 @@ class AdaScale(object):
         scale: Optional[float] = None,
         smoothing: float = 0.999,
         patch_optimizer: bool = False,
+        num_gradients_to_accumulate: int = 1,
     ):
         logging.warn("AdaScale is experimental. APIs may change. Use at your own risk.")
 
         self._optimizer = optimizer
         self._optimizer_step = optimizer.step
-        self._local_grad_sqr: Optional[torch.Tensor] = None
-        self._world_size: int = world_size if world_size is not None else torch.distributed.get_world_size()
-
-        if self._world_size <= 1:
-            raise RuntimeError("AdaScale does not support a single worker.")
+        self._local_grad_sqr: Optional[List[List[torch.Tensor]]] = None
+        # With a sharded optimizer, each rank only holds valid reduced
+        # gradients for the parameters it owns.
+        self._sharded = isinstance(optimizer, OSS)
+        if world_size is None:
+            if self._sharded:
+                world_size = cast(OSS, optimizer).world_size
+            else:
+                world_size = torch.distributed.get_world_size() if torch.distributed.is_initialized() else 1
+        self._world_size: int = world_size
+        self._num_grads_to_accum = num_gradients_to_accumulate
+        self._num_backward_calls = 0
+
+        if self._num_grads_to_accum < 1:
+            raise ValueError("num_gradients_to_accumulate should be at least 1.")
+
+        if self._world_size * self._num_grads_to_accum <= 1:
+            raise RuntimeError("AdaScale does not support a single worker without gradient accumulation.")
 
         self._optimizer.state.setdefault(
             "adascale",
             {
                 "grad_sqr_avg": np.ones(len(optimizer.param_groups)),
                 "grad_var_avg": np.zeros(len(optimizer.param_groups)),
+                "progress": 0.0,
             },
         )
 
-        self.set_scale(self._world_size if scale is None else scale)
+        self.set_scale(self._world_size * self._num_grads_to_accum if scale is None else scale)
 
         for idx, param_group in enumerate(self._optimizer.param_groups):
             for param in param_group["params"]:
@@ -110,9 +169,42 @@ class AdaScale(object):
         self._smoothing = smoothing
 
     @property
-    def state(self) -> Dict[str, np.ndarray]:
+    def state(self) -> Dict[str, Any]:
         return self._optimizer.state["adascale"]
 
+    @property
+    def progress(self) -> float:
+        """
+        Number of scale-invariant iterations done so far, i.e. the sum of the
+        gains of all the steps taken. This is the equivalent number of steps
+        at the baseline batch size, and what learning rate schedules should be
+        driven by (see :class:`AdaScaleLambdaLR`).
+        """
+        return self.state["progress"]
+
+    def state_dict(self) -> Dict[str, Any]:
+        """
+        Returns the AdaScale state, which consists of the running averages of
+        the gradient statistics and of the progress. It can be saved along
+        with the optimizer state to resume training without re-estimating the
+        statistics.
+        """
+        return copy.deepcopy(self.state)
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        """
+        Restores the AdaScale state.
+
+        Arguments:
+            state_dict (dict): AdaScale state. Should be an object returned
+                from a call to :meth:`state_dict`.
+        """
+        if len(state_dict["grad_sqr_avg"]) != len(self._optimizer.param_groups):
+            raise ValueError("The AdaScale state does not match the number of param groups of the optimizer.")
+        self.state.clear()
+        self.state.update(copy.deepcopy(state_dict))
+        self.state.setdefault("progress", 0.0)
+
     @property
     def scale(self) -> float:
         """
@@ -175,12 +267,24 @@ class AdaScale(object):
         self.state[name + "_unbias"] = unbias
         self.state[name] = biased / unbias
 
+    @staticmethod
+    def _grad_sqr(grad: torch.Tensor) -> torch.Tensor:
+        # Squared l2-norm of one gradient, left on device and accumulated in FP32.
+        return grad.float().pow(2).sum()
+
+    def _stack_grad_sqr(self, grad_sqrs: List[List[torch.Tensor]], device: torch.device) -> torch.Tensor:
+        # Sum the per-tensor squared norms of each param group into one tensor
+        # of shape (num_groups,), without any device-to-host sync.
+        return torch.stack(
+            [torch.stack(group).sum() if group else torch.zeros((), device=device) for group in grad_sqrs]
+        )
+
     def _backward_hook(self, idx: int, grad: torch.Tensor) -> None:
         # This method should be invoked once for each parameter during the
         # backward pass, before gradients are synchronized between world_size.
         if self._local_grad_sqr is None:
-            self._local_grad_sqr = torch.zeros(len(self._optimizer.param_groups), device=grad.device)
-        self._local_grad_sqr[idx] += grad.pow(2).sum()
+            self._local_grad_sqr = [[] for _ in self._optimizer.param_groups]
+        self._local_grad_sqr[idx].append(self._grad_sqr(grad))
         self._final_callback_queued = False
         Variable._execution_engine.queue_callback(self._queue_callback)
 
@@ -199,20 +303,71 @@ class AdaScale(object):
 
     def _final_callback(self) -> None:
         # This method should be invoked once for each backward pass, after
-        # gradients have been synchronized between each worker.
+        # gradients have been synchronized between each worker. When
+        # accumulating gradients, the statistics are only computed after the
+        # last backward pass before the step. With a sharded optimizer, the
+        # gradients are reduced explicitly after the backward pass, so the
+        # statistics are computed in step() instead.
         self._final_callback_queued = False
-        assert isinstance(self._local_grad_sqr, torch.Tensor)
-
-        # self._local_grad_sqr is FP32, sum then div shouldn't overflow.
-        torch.distributed.all_reduce(self._local_grad_sqr)  # SUM
-        self._local_grad_sqr.div_(self._world_size)
+        assert self._local_grad_sqr is not None
 
-        local_grad_sqr = self._local_grad_sqr.cpu().numpy()
-        total_grad_sqr = np.array(
-            [sum(param.grad.pow(2).sum().item() for param in group["params"]) for group in self._optimizer.param_groups]
-        )
-        grad_sqr = (self._world_size * total_grad_sqr - local_grad_sqr) / (self._world_size - 1)
-        grad_var = (local_grad_sqr - total_grad_sqr) * self._scale / (self._world_size - 1)
+        self._num_backward_calls += 1
+        if self._num_backward_calls < self._num_grads_to_accum:
+            return
+        self._num_backward_calls = 0
+
+        if not self._sharded:
+            self._update_grad_stats()
+
+    def _update_grad_stats(self) -> None:
+        # Update the gain statistics, from the squared norms of the local
+        # gradients collected by the backward hooks and of the reduced
+        # gradients.
+        assert self._local_grad_sqr is not None
+
+        device = next(grad_sqr.device for group in self._local_grad_sqr for grad_sqr in group)
+        local_grad_sqr = self._stack_grad_sqr(self._local_grad_sqr, device)
+
+        if self._sharded:
+            # The reduced gradients are only valid on the owner ranks, so each
+            # rank sums the squared norms of its shard, and a single all_reduce
+            # combines them along with the local squared norms.
+            optimizer = cast(OSS, self._optimizer)
+            grads = [
+                [
+                    param.grad
+                    for param in group["params"]
+                    if param.grad is not None and optimizer.param_to_rank[param] == optimizer.rank
+                ]
+                for group in self._optimizer.param_groups
+            ]
+            total_grad_sqr = self._stack_grad_sqr([[self._grad_sqr(grad) for grad in group] for group in grads], device)
+            grad_sqrs = torch.stack([local_grad_sqr, total_grad_sqr])
+            torch.distributed.all_reduce(grad_sqrs, group=optimizer.group)  # SUM
+            local_grad_sqr, total_grad_sqr = grad_sqrs
+        else:
+            grads = [
+                [param.grad for param in group["params"] if param.grad is not None]
+                for group in self._optimizer.param_groups
+            ]
+            total_grad_sqr = self._stack_grad_sqr([[self._grad_sqr(grad) for grad in group] for group in grads], device)
+
+            # local_grad_sqr is FP32, sum then div shouldn't overflow.
+            if self._world_size > 1:
+                torch.distributed.all_reduce(local_grad_sqr)  # SUM
+
+        # local_grad_sqr is the average squared norm of the gradients of each
+        # backward pass, over all workers. The accumulated gradients are the
+        # sum of these gradients, total_grad_sqr is the squared norm of their
+        # average.
+        num_grads = self._world_size * self._num_grads_to_accum
+        local_grad_sqr.div_(num_grads)
+        total_grad_sqr.div_(self._num_grads_to_accum ** 2)
+
+        # Single transfer to host for all the statistics of this step.
+        local_grad_sqr, total_grad_sqr = torch.stack([local_grad_sqr, total_grad_sqr]).cpu().numpy()
+        grad_sqr = (num_grads * total_grad_sqr - local_grad_sqr) / (num_grads - 1)
+        grad_var = (local_grad_sqr - total_grad_sqr) * self._scale / (num_grads - 1)
         grad_sqr = np.maximum(grad_sqr, 0.0)
         grad_var = np.maximum(grad_var, 1e-6)
         theta = self._smoothing ** self._scale
@@ -229,6 +384,12 @@ class AdaScale(object):
             args: Positional arguments passed to ``optimizer.step``.
             kwargs: Keyword arguments passed to ``optimizer.step``.
         """
+        assert self._num_backward_calls == 0, "AdaScale step() called in the middle of gradient accumulation"
+        if self._sharded and self._local_grad_sqr is not None:
+            self._update_grad_stats()
+
+        self.state["progress"] += self.gain()
+
         initial_lr = [pg["lr"] for pg in self._optimizer.param_groups]
         for idx, param_group in enumerate(self._optimizer.param_groups):
             grad_sqr = float(self.state["grad_sqr_avg"][idx])
@@ -254,3 +415,53 @@ class AdaScale(object):
     def zero_grad(self) -> None:
         """Proxy function to optimizer"""
         self._optimizer.zero_grad()
+
+
+class AdaScaleLambdaLR(_LRScheduler):
+    """
+    Sets the learning rate of each parameter group to the initial lr times a
+    given function of the AdaScale progress, i.e. the number of
+    scale-invariant iterations. This makes a schedule designed for the
+    baseline batch size keep the same effective shape at any scale, and
+    resume where it stopped when the AdaScale state is restored.
+
+    .. code-block:: python
+
+        adascale = AdaScale(optim)
+        scheduler = AdaScaleLambdaLR(adascale, lambda progress: 0.1 ** (progress // 10000))
+
+        for batch in ...:
+            ...
+            adascale.step()
+            scheduler.step()
+
+    Arguments:
+        adascale (AdaScale): AdaScale instance wrapping the optimizer.
+        lr_lambda (function or list): A function which computes a
+            multiplicative factor given the progress, or a list of such
+            functions, one for each group in ``optimizer.param_groups``.
+    """
+
+    def __init__(
+        self, adascale: AdaScale, lr_lambda: Union[Callable[[float], float], List[Callable[[float], float]]],
+    ):
+        self.adascale = adascale
+        optimizer = adascale._optimizer
+        if isinstance(lr_lambda, list):
+            if len(lr_lambda) != len(optimizer.param_groups):
+                raise ValueError(f"Expected {len(optimizer.param_groups)} lr_lambdas, but got {len(lr_lambda)}")
+            self.lr_lambdas = list(lr_lambda)
+        else:
+            self.lr_lambdas = [lr_lambda] * len(optimizer.param_groups)
+        super().__init__(optimizer)
+
+    def state_dict(self) -> Dict[str, Any]:
+        """
+        Returns the state of the scheduler, without the lambdas nor the
+        AdaScale instance. The progress itself is part of the AdaScale state.
+        """
+        return {key: value for key, value in self.__dict__.items() if key not in ("optimizer", "adascale", "lr_lambdas")}
+
+    def get_lr(self) -> List[float]:
+        progress = self.adascale.progress
+        return [base_lr * lmbda(progress) for lmbda, base_lr in zip(self.lr_lambdas, self.base_lrs)]
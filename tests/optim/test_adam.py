@@ -9,6 +9,8 @@ import functools
 import pytest
 import torch
 
+from fairscale.optim.adam import reference_adam_step
+
 try:
     from fairscale.optim import Adam, GradScaler, Precision
 
@@ -404,3 +406,91 @@ def test_pure_fp16_with_full_precision_parameters():
     bias = torch.randn(10, requires_grad=True).float().cuda()
     with pytest.raises(AssertionError):
         Adam([weight, bias], lr=1e-2, precision=Precision.PURE_FP16)
+
+
+def reference_train(weight, compensation=None, steps=200, lr=1e-4):
+    exp_avg = torch.zeros_like(weight)
+    exp_avg_sq = torch.zeros_like(weight)
+    target = torch.zeros_like(weight, dtype=torch.float32)
+    for step in range(1, steps + 1):
+        grad = (2 * (weight.float() - target)).to(weight.dtype)
+        reference_adam_step(weight, grad, exp_avg, exp_avg_sq, step, lr, compensation=compensation)
+    return weight
+
+
+def test_reference_matches_torch_adam():
+    weight = torch.randn(10, 5, requires_grad=True)
+    weight_c = weight.detach().clone().requires_grad_()
+    optimizer = torch.optim.Adam([weight_c], lr=1e-3)
+    exp_avg = torch.zeros_like(weight)
+    exp_avg_sq = torch.zeros_like(weight)
+
+    for step in range(1, 6):
+        grad = torch.randn_like(weight)
+        weight_c.grad = grad.clone()
+        optimizer.step()
+        reference_adam_step(weight, grad, exp_avg, exp_avg_sq, step, 1e-3)
+
+    assert torch.allclose(weight, weight_c, atol=1e-6)
+
+
+def test_reference_pure_fp16_kahan_summation():
+    initial = torch.full((16,), 1.0) + torch.rand(16) * 0.5
+    full_precision = reference_train(initial.clone())
+
+    # With a small learning rate every update is below half an FP16 ulp of the weight,
+    # so plain rounding discards all of them
+    rounded = reference_train(initial.clone().half())
+    assert torch.equal(rounded, initial.half())
+
+    weight = initial.clone().half()
+    compensated = reference_train(weight, compensation=torch.zeros_like(weight))
+    assert not torch.equal(compensated, initial.half())
+    assert torch.allclose(compensated.float(), full_precision, atol=1e-3)
+
+
+@skip_if_no_cuda
+@skip_if_no_adam
+def test_step_pure_fp16_kahan_summation():
+    weight, bias, input = make_half_precision_params()
+    optimizer = Adam([weight, bias], lr=1e-3, precision=Precision.PURE_FP16, kahan_summation=True)
+    step_test(optimizer, weight, bias, input)
+
+    assert optimizer.state[weight]["compensation"].dtype == torch.float16
+    assert optimizer.state[bias]["compensation"].dtype == torch.float16
+
+
+@skip_if_no_cuda
+@skip_if_no_adam
+def test_step_pure_fp16_kahan_summation_matches_reference():
+    weight = torch.randn(10, 5).cuda().half().requires_grad_()
+    weight_c = weight.detach().cpu().clone()
+    optimizer = Adam([weight], lr=1e-5, precision=Precision.PURE_FP16, kahan_summation=True)
+    exp_avg = torch.zeros_like(weight_c)
+    exp_avg_sq = torch.zeros_like(weight_c)
+    compensation = torch.zeros_like(weight_c)
+
+    for step in range(1, 6):
+        grad = torch.randn(10, 5).half()
+        weight.grad = grad.cuda()
+        optimizer.step()
+        reference_adam_step(
+            weight_c,
+            grad,
+            exp_avg,
+            exp_avg_sq,
+            step,
+            1e-5,
+            optim_scale=optimizer._optim_scale,
+            compensation=compensation,
+        )
+
+    assert torch.allclose(weight.detach().cpu().float(), weight_c.float(), atol=1e-3)
+
+
+@skip_if_no_cuda
+@skip_if_no_adam
+def test_kahan_summation_with_mixed_precision():
+    weight, bias, input = make_half_precision_params()
+    with pytest.raises(AssertionError):
+        Adam([weight, bias], lr=1e-3, precision=Precision.MIXED_PRECISION, kahan_summation=True)
@@ -0,0 +1,278 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All rights reserved.
+#
+# This source code is licensed under the BSD license found in the
+# LICENSE file in the root directory of this source tree.
+
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-function-docstring
+
+import copy
+import io
+import tempfile
+
+import numpy as np
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn import Linear
+from torch.nn.parallel import DistributedDataParallel
+from torch.optim import SGD
+
+from fairscale.nn.data_parallel import ShardedDataParallel
+from fairscale.optim import AdaScale, AdaScaleLambdaLR
+
+
+def dist_init(rank, world_size, tempfile_name, backend=dist.Backend.GLOO):
+    url = "file://" + tempfile_name
+    dist.init_process_group(init_method=url, backend=backend, rank=rank, world_size=world_size)
+
+
+def run_test_gain(rank, world_size, tempfile_name):
+    dist_init(rank, world_size, tempfile_name)
+
+    model = Linear(2, 2, bias=False)
+    with torch.no_grad():
+        model.weight.fill_(1.0)
+    model = DistributedDataParallel(model)
+    optim = AdaScale(SGD(model.parameters(), lr=0.1), smoothing=0.0)
+
+    # Every row of the weight gradient is the input of the rank
+    # rank 0: [[1, 1], [1, 1]], rank 1: [[2, 1], [2, 1]], average: [[1.5, 1], [1.5, 1]]
+    input = torch.tensor([[rank + 1.0, 1.0]])
+    model(input).sum().backward()
+
+    local_grad_sqr = (4.0 + 10.0) / 2
+    total_grad_sqr = 6.5
+    grad_sqr = (world_size * total_grad_sqr - local_grad_sqr) / (world_size - 1)
+    grad_var = (local_grad_sqr - total_grad_sqr) * world_size / (world_size - 1)
+    assert np.allclose(optim.grad_sqr_avg(), grad_sqr)
+    assert np.allclose(optim.grad_var_avg(), grad_var)
+    assert np.allclose(optim.gain(), (grad_var + grad_sqr) / (grad_var / world_size + grad_sqr))
+
+    optim.step()
+    assert torch.allclose(model.module.weight, 1.0 - 0.1 * optim.gain() * torch.tensor([[1.5, 1.0], [1.5, 1.0]]))
+
+    dist.destroy_process_group()
+
+
+def test_gain():
+    world_size = 2
+    temp_file_name = tempfile.mkstemp()[1]
+    mp.spawn(run_test_gain, args=(world_size, temp_file_name), nprocs=world_size, join=True)
+
+
+def run_test_multiple_groups(rank, world_size, tempfile_name):
+    dist_init(rank, world_size, tempfile_name)
+
+    model = torch.nn.Sequential(Linear(2, 2), Linear(2, 1))
+    model = DistributedDataParallel(model)
+    params = list(model.parameters())
+    optim = AdaScale(SGD([{"params": params[:2]}, {"params": params[2:]}], lr=0.1))
+
+    torch.manual_seed(rank)
+    model(torch.rand(4, 2)).sum().backward()
+
+    assert optim.state["grad_sqr_avg"].shape == (2,)
+    assert optim.state["grad_var_avg"].shape == (2,)
+    assert np.isfinite(optim.gain())
+    optim.step()
+
+    dist.destroy_process_group()
+
+
+def test_multiple_groups():
+    world_size = 2
+    temp_file_name = tempfile.mkstemp()[1]
+    mp.spawn(run_test_multiple_groups, args=(world_size, temp_file_name), nprocs=world_size, join=True)
+
+
+# Gradients of the weight of a Linear(2, 2) filled with ones, for the inputs
+# [[k, 1]] with k = 1..4: each has squared norm 2 * (k ** 2 + 1) and their
+# average is [[2.5, 1], [2.5, 1]].
+ACCUM_LOCAL_GRAD_SQR = (4.0 + 10.0 + 20.0 + 34.0) / 4
+ACCUM_TOTAL_GRAD_SQR = 14.5
+
+
+def check_accumulated_gain(optim, num_grads):
+    grad_sqr = (num_grads * ACCUM_TOTAL_GRAD_SQR - ACCUM_LOCAL_GRAD_SQR) / (num_grads - 1)
+    grad_var = (ACCUM_LOCAL_GRAD_SQR - ACCUM_TOTAL_GRAD_SQR) * num_grads / (num_grads - 1)
+    assert np.allclose(optim.grad_sqr_avg(), grad_sqr)
+    assert np.allclose(optim.grad_var_avg(), grad_var)
+
+
+def make_accumulation_model():
+    model = Linear(2, 2, bias=False)
+    with torch.no_grad():
+        model.weight.fill_(1.0)
+    return model
+
+
+def test_gradient_accumulation():
+    model = make_accumulation_model()
+    optim = AdaScale(SGD(model.parameters(), lr=0.1), smoothing=0.0, num_gradients_to_accumulate=4)
+    assert optim.scale == 4
+
+    for k in range(1, 5):
+        model(torch.tensor([[float(k), 1.0]])).sum().backward()
+        if k < 4:
+            with pytest.raises(AssertionError):
+                optim.step()
+
+    check_accumulated_gain(optim, 4)
+    optim.step()
+    expected = 1.0 - 0.1 * optim.gain() * torch.tensor([[10.0, 4.0], [10.0, 4.0]])
+    assert torch.allclose(model.weight, expected)
+
+
+def test_single_worker_without_accumulation():
+    model = make_accumulation_model()
+    with pytest.raises(RuntimeError):
+        AdaScale(SGD(model.parameters(), lr=0.1))
+
+
+def run_test_gradient_accumulation_ddp(rank, world_size, tempfile_name):
+    dist_init(rank, world_size, tempfile_name)
+
+    model = DistributedDataParallel(make_accumulation_model())
+    optim = AdaScale(SGD(model.parameters(), lr=0.1), smoothing=0.0, num_gradients_to_accumulate=2)
+    assert optim.scale == 4
+
+    with model.no_sync():
+        model(torch.tensor([[2.0 * rank + 1, 1.0]])).sum().backward()
+    model(torch.tensor([[2.0 * rank + 2, 1.0]])).sum().backward()
+
+    # Same statistics as accumulating the four micro-batches on a single worker
+    check_accumulated_gain(optim, 4)
+
+    dist.destroy_process_group()
+
+
+def test_gradient_accumulation_ddp():
+    world_size = 2
+    temp_file_name = tempfile.mkstemp()[1]
+    mp.spawn(run_test_gradient_accumulation_ddp, args=(world_size, temp_file_name), nprocs=world_size, join=True)
+
+
+def run_test_sharded_data_parallel(rank, world_size, tempfile_name):
+    dist_init(rank, world_size, tempfile_name)
+
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(Linear(2, 3), Linear(3, 3), Linear(3, 1))
+    sharded_model = copy.deepcopy(model)
+
+    ddp = DistributedDataParallel(model)
+    ddp_optim = AdaScale(SGD(ddp.parameters(), lr=0.1), smoothing=0.5)
+    sdp = ShardedDataParallel(sharded_model, SGD, {"lr": 0.1}, world_size, broadcast_buffers=False)
+    sdp_optim = AdaScale(sdp.optimizer, smoothing=0.5)
+    assert sdp_optim.scale == world_size
+
+    torch.manual_seed(rank)
+    for _ in range(3):
+        input = torch.rand(4, 2)
+
+        ddp_optim.zero_grad()
+        ddp(input).sum().backward()
+        ddp_optim.step()
+
+        sdp_optim.zero_grad()
+        sdp(input).sum().backward()
+        sdp.reduce()
+        sdp_optim.step()
+
+        assert np.allclose(ddp_optim.grad_sqr_avg(), sdp_optim.grad_sqr_avg(), rtol=1e-3)
+        assert np.allclose(ddp_optim.grad_var_avg(), sdp_optim.grad_var_avg(), rtol=1e-3)
+
+    for p, sharded_p in zip(ddp.parameters(), sdp.parameters()):
+        assert torch.allclose(p, sharded_p)
+
+    dist.destroy_process_group()
+
+
+def test_sharded_data_parallel():
+    world_size = 2
+    temp_file_name = tempfile.mkstemp()[1]
+    mp.spawn(run_test_sharded_data_parallel, args=(world_size, temp_file_name), nprocs=world_size, join=True)
+
+
+def run_accumulation_steps(model, optim, steps, scheduler=None):
+    for _ in range(steps):
+        for _ in range(2):
+            model(torch.rand(4, 2)).sum().backward()
+        optim.step()
+        optim.zero_grad()
+        if scheduler is not None:
+            scheduler.step()
+
+
+def test_progress():
+    model = Linear(2, 2)
+    optim = AdaScale(SGD(model.parameters(), lr=0.1), num_gradients_to_accumulate=2)
+    assert optim.progress == 0.0
+
+    progress = 0.0
+    for _ in range(3):
+        for _ in range(2):
+            model(torch.rand(4, 2)).sum().backward()
+        gain = optim.gain()
+        optim.step()
+        optim.zero_grad()
+        progress += gain
+        assert np.allclose(optim.progress, progress)
+    assert optim.progress > 3
+
+
+def test_state_dict():
+    torch.manual_seed(0)
+    model = Linear(2, 2)
+    optim = AdaScale(SGD(model.parameters(), lr=0.1), num_gradients_to_accumulate=2)
+    run_accumulation_steps(model, optim, 3)
+
+    buffer = io.BytesIO()
+    torch.save(optim.state_dict(), buffer)
+    buffer.seek(0)
+
+    resumed_model = copy.deepcopy(model)
+    resumed_optim = AdaScale(SGD(resumed_model.parameters(), lr=0.1), num_gradients_to_accumulate=2)
+    resumed_optim.load_state_dict(torch.load(buffer))
+    assert resumed_optim.progress == optim.progress
+    assert resumed_optim.gain() == optim.gain()
+
+    # Resuming leads to the same statistics as not interrupting the training
+    torch.manual_seed(1)
+    run_accumulation_steps(model, optim, 2)
+    torch.manual_seed(1)
+    run_accumulation_steps(resumed_model, resumed_optim, 2)
+    assert np.allclose(resumed_optim.progress, optim.progress)
+    assert np.allclose(resumed_optim.state["grad_sqr_avg"], optim.state["grad_sqr_avg"])
+    assert np.allclose(resumed_optim.state["grad_var_avg"], optim.state["grad_var_avg"])
+
+    # The state of another optimizer can't be loaded
+    other_optim = AdaScale(
+        SGD([{"params": [model.weight]}, {"params": [model.bias]}], lr=0.1), num_gradients_to_accumulate=2
+    )
+    with pytest.raises(ValueError):
+        other_optim.load_state_dict(optim.state_dict())
+
+
+def test_lr_scheduler():
+    model = Linear(2, 2)
+    sgd = SGD(model.parameters(), lr=0.1)
+    optim = AdaScale(sgd, num_gradients_to_accumulate=2)
+    scheduler = AdaScaleLambdaLR(optim, lambda progress: 1.0 / (1.0 + progress))
+    assert sgd.param_groups[0]["lr"] == 0.1
+
+    run_accumulation_steps(model, optim, 3, scheduler)
+    assert optim.progress > 3
+    assert np.allclose(sgd.param_groups[0]["lr"], 0.1 / (1.0 + optim.progress))
+
+    # The progress is part of the AdaScale state, the scheduler only needs its base learning rates
+    scheduler_state = scheduler.state_dict()
+    assert "adascale" not in scheduler_state
+    resumed_sgd = SGD(model.parameters(), lr=0.1)
+    resumed_optim = AdaScale(resumed_sgd, num_gradients_to_accumulate=2)
+    resumed_optim.load_state_dict(optim.state_dict())
+    resumed_scheduler = AdaScaleLambdaLR(resumed_optim, lambda progress: 1.0 / (1.0 + progress))
+    resumed_scheduler.load_state_dict(scheduler_state)
+    assert np.allclose(resumed_sgd.param_groups[0]["lr"], sgd.param_groups[0]["lr"])